@@ -0,0 +1,398 @@
+"""Headless load test harness for the e-commerce server.
+
+Replays the journeys of the Robot Framework suites over plain HTTP instead of a
+browser: signup, login, browse, add to cart, checkout, payment and refund
+request. Each virtual user runs the journey in a loop. At the end, the harness
+prints throughput, latency percentiles and error rate per step.
+
+Usage:
+
+    python tests/load/loadtest.py --users 20 --duration 60
+    python tests/load/loadtest.py --manage ../django-ecommerce/manage.py --stripe-stub 12111
+
+The payment step needs the server's Stripe calls to go to a local stub instead
+of api.stripe.com. Either start the built-in stub with --stripe-stub PORT, or
+run stripe-mock, and point the server at it in a local settings module:
+
+    import stripe
+    stripe.api_base = "http://localhost:12111"
+
+The server doesn't show ref codes to customers, so by default the refund step
+posts random codes, which exercises the order lookup and the "does not exist"
+path. Pass --ref-codes FILE (one code per line) to request refunds for real
+orders.
+
+Only the standard library is used, so the harness runs on any machine that can
+run the SUT.
+"""
+import argparse
+import http.client
+import http.cookiejar
+import itertools
+import json
+import random
+import re
+import string
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+STEPS = ('signup', 'login', 'browse', 'add_to_cart', 'order_summary',
+         'checkout', 'payment', 'refund_request')
+
+
+class StepFailed(Exception):
+    pass
+
+
+# http.client errors such as IncompleteRead and BadStatusLine are not OSErrors.
+STEP_ERRORS = (StepFailed, OSError, http.client.HTTPException)
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+class Browser:
+    """A cookie-keeping HTTP client that returns redirects instead of following them."""
+
+    def __init__(self, base_url, timeout):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.cookies = http.cookiejar.CookieJar()
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(self.cookies),
+                                                  NoRedirect)
+
+    def csrf_token(self):
+        for cookie in self.cookies:
+            if cookie.name == 'csrftoken':
+                return cookie.value
+        return ''
+
+    def request(self, method, path, data=None):
+        url = path if path.startswith('http') else self.base_url + path
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        request = urllib.request.Request(url, data=body, method=method)
+        if method == 'POST':
+            request.add_header('X-CSRFToken', self.csrf_token())
+            request.add_header('Referer', url)
+        try:
+            with self.opener.open(request, timeout=self.timeout) as response:
+                return response.status, response.headers, response.read().decode('utf-8', 'replace')
+        except urllib.error.HTTPError as e:
+            return e.code, e.headers, e.read().decode('utf-8', 'replace')
+
+    def get(self, path):
+        return self.request('GET', path)
+
+    def post(self, path, data):
+        return self.request('POST', path, data)
+
+
+def expect(response, status, contains=None):
+    code, headers, body = response
+    if code != status:
+        raise StepFailed(f"expected HTTP {status}, got {code}")
+    if contains and contains not in body:
+        raise StepFailed(f"response doesn't contain {contains!r}")
+    return headers.get('Location', '')
+
+
+class Journey:
+    """One pass through the shop, mirroring the Robot Framework suites."""
+
+    def __init__(self, options, record):
+        self.options = options
+        self.record = record
+
+    def step(self, name, action):
+        start = time.perf_counter()
+        try:
+            result = action()
+        except STEP_ERRORS as e:
+            self.record(name, time.perf_counter() - start, str(e))
+            raise
+        self.record(name, time.perf_counter() - start, None)
+        return result
+
+    def run(self, user_id):
+        options = self.options
+        username = f"load{user_id}{''.join(random.choices(string.ascii_lowercase, k=8))}"
+        password = options.password
+
+        signup_browser = Browser(options.url, options.timeout)
+        browser = Browser(options.url, options.timeout)
+
+        def signup():
+            signup_browser.get('/accounts/signup/')
+            expect(signup_browser.post('/accounts/signup/', {'username': username,
+                                                             'email': '',
+                                                             'password1': password,
+                                                             'password2': password}), 302)
+
+        def login():
+            browser.get('/accounts/login/')
+            expect(browser.post('/accounts/login/', {'login': username, 'password': password}), 302)
+
+        def browse():
+            expect(browser.get('/'), 200)
+            expect(browser.get(f'/product/{options.slug}/'), 200)
+
+        def add_to_cart():
+            expect(browser.get(f'/add-to-cart/{options.slug}/'), 302)
+
+        def order_summary():
+            expect(browser.get('/order-summary/'), 200, 'Order Summary')
+
+        def checkout():
+            expect(browser.get('/checkout/'), 200)
+            location = expect(browser.post('/checkout/', {'shipping_address': '123 Main St',
+                                                         'shipping_zip': '12345',
+                                                         'shipping_country': 'US',
+                                                         'same_billing_address': 'on',
+                                                         'payment_option': 'S'}), 302)
+            if '/payment/' not in location:
+                raise StepFailed(f"redirected to {location!r} instead of payment")
+            return location
+
+        def payment(payment_url):
+            expect(browser.get(payment_url), 200)
+            expect(browser.post(payment_url, {'stripeToken': 'tok_visa'}), 302)
+            expect(browser.get('/'), 200, 'Your order was successful!')
+
+        def refund_request():
+            ref_code = (random.choice(options.ref_codes) if options.ref_codes
+                        else ''.join(random.choices(string.ascii_lowercase + string.digits, k=20)))
+            browser.get('/request-refund/')
+            expect(browser.post('/request-refund/', {'ref_code': ref_code,
+                                                     'message': 'Load test refund',
+                                                     'email': f'{username}@example.com'}), 302)
+
+        self.step('signup', signup)
+        self.step('login', login)
+        self.step('browse', browse)
+        self.step('add_to_cart', add_to_cart)
+        self.step('order_summary', order_summary)
+        payment_url = self.step('checkout', checkout)
+        self.step('payment', lambda: payment(payment_url))
+        self.step('refund_request', refund_request)
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {step: [] for step in STEPS}
+        self.errors = {step: {} for step in STEPS}
+        self.journeys = 0
+
+    def record(self, step, seconds, error):
+        with self.lock:
+            self.latencies[step].append(seconds * 1000)
+            if error:
+                self.errors[step][error] = self.errors[step].get(error, 0) + 1
+
+    def report(self, elapsed):
+        rows = []
+        for step in STEPS:
+            latencies = sorted(self.latencies[step])
+            count = len(latencies)
+            errors = sum(self.errors[step].values())
+            rows.append({'step': step,
+                         'requests': count,
+                         'throughput': count / elapsed,
+                         'error_rate': errors / count if count else 0.0,
+                         'p50_ms': percentile(latencies, 50),
+                         'p95_ms': percentile(latencies, 95),
+                         'p99_ms': percentile(latencies, 99),
+                         'errors': self.errors[step]})
+        return {'elapsed_s': elapsed, 'journeys': self.journeys,
+                'journeys_per_s': self.journeys / elapsed, 'steps': rows}
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def print_report(report):
+    print(f"{report['journeys']} journeys in {report['elapsed_s']:.1f} s "
+          f"({report['journeys_per_s']:.2f}/s)")
+    print(f"{'step':<16}{'requests':>10}{'req/s':>9}{'errors':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for row in report['steps']:
+        print(f"{row['step']:<16}{row['requests']:>10}{row['throughput']:>9.2f}"
+              f"{row['error_rate']:>9.1%}{row['p50_ms']:>10.1f}{row['p95_ms']:>10.1f}{row['p99_ms']:>10.1f}")
+    for row in report['steps']:
+        for error, count in row['errors'].items():
+            print(f"  {row['step']}: {count} x {error}")
+
+
+class StripeStubHandler(BaseHTTPRequestHandler):
+    """Answers the Stripe API calls PaymentView makes with canned objects."""
+    ids = itertools.count(1)
+    latency = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def form(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return dict(urllib.parse.parse_qsl(self.rfile.read(length).decode()))
+
+    def customer(self, customer_id):
+        return {'id': customer_id, 'object': 'customer',
+                'sources': {'object': 'list', 'data': [], 'has_more': False,
+                            'url': f'/v1/customers/{customer_id}/sources'}}
+
+    def card(self, customer_id):
+        return {'id': f'card_{next(self.ids)}', 'object': 'card', 'customer': customer_id,
+                'last4': '4242', 'exp_month': 12, 'exp_year': 2030}
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        path = urllib.parse.urlparse(self.path).path
+        match = re.fullmatch(r'/v1/customers/([^/]+)(/sources)?', path)
+        if not match:
+            return self.send_json(404, {'error': {'type': 'invalid_request_error',
+                                                  'message': f'Unrecognized request URL: {path}'}})
+        if match.group(2):
+            return self.send_json(200, {'object': 'list', 'data': [self.card(match.group(1))],
+                                        'has_more': False})
+        return self.send_json(200, self.customer(match.group(1)))
+
+    def do_POST(self):
+        time.sleep(self.latency)
+        path = urllib.parse.urlparse(self.path).path
+        form = self.form()
+        if path == '/v1/customers':
+            return self.send_json(200, self.customer(f'cus_{next(self.ids)}'))
+        match = re.fullmatch(r'/v1/customers/([^/]+)/sources', path)
+        if match:
+            return self.send_json(200, self.card(match.group(1)))
+        if path == '/v1/charges':
+            return self.send_json(200, {'id': f'ch_{next(self.ids)}', 'object': 'charge',
+                                        'amount': int(form.get('amount', 0)),
+                                        'currency': form.get('currency', 'usd'),
+                                        'paid': True, 'status': 'succeeded'})
+        if path == '/v1/refunds':
+            return self.send_json(200, {'id': f're_{next(self.ids)}', 'object': 'refund',
+                                        'charge': form.get('charge'), 'status': 'succeeded'})
+        return self.send_json(404, {'error': {'type': 'invalid_request_error',
+                                              'message': f'Unrecognized request URL: {path}'}})
+
+
+def start_stripe_stub(port, latency_ms):
+    StripeStubHandler.latency = latency_ms / 1000
+    server = ThreadingHTTPServer(('127.0.0.1', port), StripeStubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_server(manage, url, timeout=30):
+    address = urllib.parse.urlparse(url).netloc
+    process = subprocess.Popen([sys.executable, manage, 'runserver', '--noreload', address])
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"server at {url} exited with code {process.returncode} before it started")
+        try:
+            urllib.request.urlopen(url, timeout=1).close()
+            return process
+        except urllib.error.HTTPError:
+            return process
+        except (OSError, http.client.HTTPException):
+            time.sleep(0.5)
+    process.terminate()
+    process.wait()
+    raise SystemExit(f"server at {url} didn't start within {timeout} s")
+
+
+def run(options):
+    stats = Stats()
+    stop_at = time.monotonic() + options.duration
+    user_ids = itertools.count(1)
+    ids_lock = threading.Lock()
+
+    def virtual_user():
+        journey = Journey(options, stats.record)
+        iterations = 0
+        while time.monotonic() < stop_at and (not options.iterations or iterations < options.iterations):
+            with ids_lock:
+                user_id = next(user_ids)
+            try:
+                journey.run(user_id)
+            except STEP_ERRORS:
+                pass
+            else:
+                with stats.lock:
+                    stats.journeys += 1
+            iterations += 1
+
+    start = time.monotonic()
+    threads = [threading.Thread(target=virtual_user) for _ in range(options.users)]
+    for thread in threads:
+        thread.start()
+        time.sleep(options.ramp_up / max(options.users, 1))
+    for thread in threads:
+        thread.join()
+    return stats.report(time.monotonic() - start)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://localhost:8000')
+    parser.add_argument('--users', type=int, default=10, help='concurrent virtual users')
+    parser.add_argument('--duration', type=float, default=60, help='seconds to run')
+    parser.add_argument('--iterations', type=int, default=0,
+                        help='journeys per user, 0 for no limit within --duration')
+    parser.add_argument('--ramp-up', type=float, default=0, help='seconds to start all users')
+    parser.add_argument('--timeout', type=float, default=30, help='HTTP timeout in seconds')
+    parser.add_argument('--slug', default='shirt', help='product used in the journey')
+    parser.add_argument('--password', default='loadtest123')
+    parser.add_argument('--ref-codes', type=argparse.FileType(), help='file of ref codes to refund')
+    parser.add_argument('--stripe-stub', type=int, metavar='PORT', help='start the Stripe stub')
+    parser.add_argument('--stripe-latency-ms', type=float, default=0,
+                        help='delay added to every Stripe stub response')
+    parser.add_argument('--manage', help='start the server with this manage.py')
+    parser.add_argument('--json', type=argparse.FileType('w'), help='also write the report as JSON')
+    options = parser.parse_args(argv)
+    options.ref_codes = ([line.strip() for line in options.ref_codes if line.strip()]
+                         if options.ref_codes else [])
+    return options
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    stub = start_stripe_stub(options.stripe_stub, options.stripe_latency_ms) if options.stripe_stub else None
+    server = start_server(options.manage, options.url) if options.manage else None
+    try:
+        report = run(options)
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+        if stub:
+            stub.shutdown()
+    print_report(report)
+    if options.json:
+        json.dump(report, options.json, indent=2)
+    failed = sum(sum(row['errors'].values()) for row in report['steps'])
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,329 @@
+import json
+import os
+import statistics
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from unittest.mock import patch, Mock
+
+from django.test import TestCase, Client
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+from django.contrib.auth.models import User
+from django.contrib.messages import get_messages
+from django.urls import reverse
+from core.models import Item, Order, OrderItem, Address, UserProfile
+
+CATALOGUE_SIZES = (10, 100, 1000)
+CART_SIZES = (1, 10, 50)
+HISTORY_SIZES = (0, 10, 100)
+# Cart sizes for the PaymentView POST run, where order finalisation scales with the cart.
+FINALISATION_CART_SIZES = (1, 10, 100, 1000)
+
+# Per-request query budgets, set to the current cost of each view: a fixed part
+# plus queries_per_line for every line in the cart. The cost per line is also
+# checked exactly between the two largest cart sizes, so a new N+1 query fails
+# even where the total would still fit in the budget. The numbers were measured
+# with the SQLite test database.
+BUDGETS = {
+    'home': {'queries': 5, 'queries_per_line': 0},
+    'product': {'queries': 4, 'queries_per_line': 0},
+    # The item of every line is loaded once in the table and twice more by the
+    # two get_total() calls in the template.
+    'order_summary': {'queries': 9, 'queries_per_line': 3},
+    # order_snippet loads the item of every line once in the list and once in get_total().
+    'checkout': {'queries': 10, 'queries_per_line': 2},
+    'payment_get': {'queries': 10, 'queries_per_line': 2},
+    # get_total() runs twice, and every OrderItem is saved on its own.
+    'payment_post': {'queries': 10, 'queries_per_line': 3},
+    'add_to_cart': {'queries': 8, 'queries_per_line': 0},
+    'remove_single_item_from_cart': {'queries': 8, 'queries_per_line': 0},
+}
+
+# Latency and allocations are only measured with BENCHMARK=1, since wall-clock
+# numbers depend on the machine. They are only checked against budgets measured
+# on that machine, read from the JSON file in BENCHMARK_BUDGETS, for example
+# {"home": {"p95_ms": 40, "peak_kib": 900, "peak_kib_per_line": 0}}.
+BENCHMARK = bool(os.environ.get('BENCHMARK'))
+TIMING_BUDGETS = {}
+if os.environ.get('BENCHMARK_BUDGETS'):
+    with open(os.environ['BENCHMARK_BUDGETS']) as budgets_file:
+        TIMING_BUDGETS = json.load(budgets_file)
+
+
+def create_items(start, stop):
+    Item.objects.bulk_create([Item(title=f"Item {i}",
+                                   price=float(10),
+                                   discount_price=float(8) if i % 2 else None,
+                                   category="S",
+                                   label="P",
+                                   slug=f"item-{i}",
+                                   description=f"Item {i}",
+                                   image=None) for i in range(start, stop)])
+
+
+def create_order(user, lines, ordered=False, **kwargs):
+    order = Order.objects.create(user=user,
+                                 ordered=ordered,
+                                 ordered_date=datetime.now(timezone.utc),
+                                 **kwargs)
+    OrderItem.objects.bulk_create([OrderItem(user=user, ordered=ordered, item=item, quantity=2)
+                                   for item in Item.objects.order_by('id')[:lines]])
+    # bulk_create doesn't set primary keys on every backend, so query the new rows.
+    order.items.add(*OrderItem.objects.filter(user=user, ordered=ordered, order__isnull=True))
+    return order
+
+
+class ViewBudgetTestCase(TestCase):
+    """Measures the query count of a view, and with BENCHMARK=1 its latency and peak allocations."""
+    repeat = int(os.environ.get('BENCHMARK_REPEAT', 20))
+    latency_factor = float(os.environ.get('BENCHMARK_LATENCY_FACTOR', 1))
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.results = []
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username="testuser")
+        cls.user.set_password("testpassword")
+        cls.user.save()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        if BENCHMARK:
+            for view, scale, result in cls.results:
+                print(f"{cls.__name__} {view} {scale}: {result['queries']} queries, "
+                      f"p50 {result['p50_ms']:.1f} ms, p95 {result['p95_ms']:.1f} ms, "
+                      f"peak {result['peak_kib']:.0f} KiB")
+
+    def setUp(self):
+        self.client = Client()
+        self.assertTrue(self.client.login(username="testuser", password="testpassword"))
+
+    def measure(self, request, prepare=None, check=None):
+        def run():
+            if prepare:
+                prepare()
+            start = time.perf_counter()
+            response = request()
+            elapsed = (time.perf_counter() - start) * 1000
+            self.assertLess(response.status_code, 400)
+            if check:
+                check(response)
+            return elapsed
+
+        # Warm up template and URL caches before measuring.
+        run()
+
+        if prepare:
+            prepare()
+        with CaptureQueriesContext(connection) as queries:
+            response = request()
+        self.assertLess(response.status_code, 400)
+        if check:
+            check(response)
+        result = {'queries': len(queries)}
+
+        if BENCHMARK:
+            timings = sorted(run() for _ in range(self.repeat))
+            if prepare:
+                prepare()
+            tracemalloc.start()
+            response = request()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            if check:
+                check(response)
+            result.update({'p50_ms': statistics.median(timings),
+                           'p95_ms': timings[int(0.95 * (len(timings) - 1))],
+                           'peak_kib': peak / 1024})
+        return result
+
+    def assertWithinBudget(self, view, result, lines=0, scale=''):
+        self.results.append((view, scale, result))
+        budget = BUDGETS[view]
+        self.assertLessEqual(result['queries'],
+                             budget['queries'] + budget['queries_per_line'] * lines,
+                             f"{view} query budget exceeded: {result}")
+        timing_budget = TIMING_BUDGETS.get(view)
+        if BENCHMARK and timing_budget:
+            self.assertLessEqual(result['p95_ms'],
+                                 timing_budget['p95_ms'] * self.latency_factor,
+                                 f"{view} latency budget exceeded: {result}")
+            self.assertLessEqual(result['peak_kib'],
+                                 timing_budget['peak_kib'] + timing_budget.get('peak_kib_per_line', 0) * lines,
+                                 f"{view} allocation budget exceeded: {result}")
+
+    def assertQueriesPerLine(self, view, queries_by_lines):
+        small, large = sorted(queries_by_lines)[-2:]
+        self.assertEqual((queries_by_lines[large] - queries_by_lines[small]) / (large - small),
+                         BUDGETS[view]['queries_per_line'],
+                         f"{view} queries per cart line changed: {queries_by_lines}")
+
+
+class CatalogueBudgetTest(ViewBudgetTestCase):
+    def grow_catalogue(self, size):
+        create_items(Item.objects.count(), size)
+        self.assertEqual(Item.objects.count(), size)
+
+    def test_home_view(self):
+        for size in CATALOGUE_SIZES:
+            with self.subTest(catalogue=size):
+                self.grow_catalogue(size)
+                result = self.measure(lambda: self.client.get('/'))
+                self.assertWithinBudget('home', result, scale=f"catalogue={size}")
+
+    def test_item_detail_view(self):
+        for size in CATALOGUE_SIZES:
+            with self.subTest(catalogue=size):
+                self.grow_catalogue(size)
+                result = self.measure(lambda: self.client.get(f'/product/item-{size - 1}/'))
+                self.assertWithinBudget('product', result, scale=f"catalogue={size}")
+
+
+class CartBudgetTest(ViewBudgetTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        create_items(0, max(CART_SIZES))
+
+    def reset_cart(self, lines):
+        Order.objects.filter(user=self.user, ordered=False).delete()
+        OrderItem.objects.filter(user=self.user, ordered=False).delete()
+        return create_order(self.user, lines)
+
+    def test_order_summary_view(self):
+        queries_by_lines = {}
+        for lines in CART_SIZES:
+            with self.subTest(cart=lines):
+                self.reset_cart(lines)
+                result = self.measure(lambda: self.client.get('/order-summary/'))
+                queries_by_lines[lines] = result['queries']
+                self.assertWithinBudget('order_summary', result, lines, f"cart={lines}")
+        self.assertQueriesPerLine('order_summary', queries_by_lines)
+
+    def test_order_summary_view_order_history(self):
+        created = 0
+        for size in HISTORY_SIZES:
+            with self.subTest(history=size):
+                for _ in range(created, size):
+                    create_order(self.user, 1, ordered=True)
+                created = size
+                self.reset_cart(1)
+                result = self.measure(lambda: self.client.get('/order-summary/'))
+                self.assertWithinBudget('order_summary', result, 1, f"history={size}")
+
+    def test_checkout_view(self):
+        queries_by_lines = {}
+        for lines in CART_SIZES:
+            with self.subTest(cart=lines):
+                self.reset_cart(lines)
+                result = self.measure(lambda: self.client.get(reverse('core:checkout')))
+                queries_by_lines[lines] = result['queries']
+                self.assertWithinBudget('checkout', result, lines, f"cart={lines}")
+        self.assertQueriesPerLine('checkout', queries_by_lines)
+
+    def test_add_to_cart(self):
+        queries_by_lines = {}
+        for lines in CART_SIZES:
+            with self.subTest(cart=lines):
+                self.reset_cart(lines)
+                result = self.measure(lambda: self.client.post('/add-to-cart/item-0/'))
+                queries_by_lines[lines] = result['queries']
+                self.assertWithinBudget('add_to_cart', result, lines, f"cart={lines}")
+        self.assertQueriesPerLine('add_to_cart', queries_by_lines)
+
+    def test_remove_single_item_from_cart(self):
+        queries_by_lines = {}
+        for lines in CART_SIZES:
+            with self.subTest(cart=lines):
+                self.reset_cart(lines)
+                OrderItem.objects.filter(user=self.user, ordered=False).update(quantity=self.repeat + 10)
+                result = self.measure(lambda: self.client.post('/remove-item-from-cart/item-0/'))
+                queries_by_lines[lines] = result['queries']
+                self.assertWithinBudget('remove_single_item_from_cart', result, lines, f"cart={lines}")
+        self.assertQueriesPerLine('remove_single_item_from_cart', queries_by_lines)
+
+
+class PaymentBudgetTest(ViewBudgetTestCase):
+    form_data = {'stripeToken': 'valid-stripe-token', 'save': True, 'use_default': True}
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        create_items(0, max(CART_SIZES + FINALISATION_CART_SIZES))
+
+    def setUp(self):
+        super().setUp()
+        self.billing_address = Address.objects.create(user=self.user,
+                                                      street_address="Test street",
+                                                      apartment_address="1",
+                                                      country="US",
+                                                      zip="00000",
+                                                      address_type='B')
+        user_profile = UserProfile.objects.get(user=self.user)
+        user_profile.stripe_customer_id = 'valid-stripe-customer-id'
+        user_profile.save()
+        self.url = reverse('core:payment', kwargs={"payment_option": "stripe"})
+
+    def reset_cart(self, lines):
+        Order.objects.filter(user=self.user, ordered=False).delete()
+        OrderItem.objects.filter(user=self.user, ordered=False).delete()
+        return create_order(self.user, lines, billing_address=self.billing_address)
+
+    def reset_cart_and_messages(self, lines):
+        # The redirect to '/' is never followed, so the messages cookie would keep
+        # every message since the first request.
+        self.client.cookies.pop('messages', None)
+        return self.reset_cart(lines)
+
+    def check_order_successful(self, response):
+        # Stripe errors also redirect to '/', so make sure the charge path was measured.
+        self.assertEqual([str(message) for message in get_messages(response.wsgi_request)],
+                         ["Your order was successful!"])
+        order = Order.objects.filter(user=self.user).latest('id')
+        self.assertTrue(order.ordered)
+        self.assertIsNotNone(order.payment)
+
+    @patch('stripe.Customer.list_sources', return_value={'data': []})
+    def test_payment_view_get(self, mock_list_sources):
+        queries_by_lines = {}
+        for lines in CART_SIZES:
+            with self.subTest(cart=lines):
+                self.reset_cart(lines)
+                result = self.measure(lambda: self.client.get(self.url))
+                queries_by_lines[lines] = result['queries']
+                self.assertWithinBudget('payment_get', result, lines, f"cart={lines}")
+        self.assertQueriesPerLine('payment_get', queries_by_lines)
+
+    @patch('stripe.Customer.retrieve', return_value=Mock())
+    @patch('stripe.Charge.create', return_value={'id': 'charge-id'})
+    def test_payment_view_post(self, mock_charge, mock_retrieve):
+        queries_by_lines = {}
+        for lines in FINALISATION_CART_SIZES:
+            with self.subTest(cart=lines):
+                result = self.measure(lambda: self.client.post(self.url, self.form_data),
+                                      prepare=lambda: self.reset_cart_and_messages(lines),
+                                      check=self.check_order_successful)
+                queries_by_lines[lines] = result['queries']
+                self.assertWithinBudget('payment_post', result, lines, f"cart={lines}")
+        self.assertQueriesPerLine('payment_post', queries_by_lines)
+
+    @patch('stripe.Customer.retrieve', return_value=Mock())
+    @patch('stripe.Charge.create', return_value={'id': 'charge-id'})
+    def test_payment_view_post_finalisation_statements(self, mock_charge, mock_retrieve):
+        # Finalising the order should take the same number of writes for any cart size.
+        # Expected to fail until PaymentView stops saving every OrderItem on its own.
+        writes_by_lines = {}
+        for lines in FINALISATION_CART_SIZES:
+            self.reset_cart_and_messages(lines)
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post(self.url, self.form_data)
+            self.check_order_successful(response)
+            writes_by_lines[lines] = len([query for query in queries.captured_queries
+                                          if query['sql'].startswith(('UPDATE', 'INSERT'))])
+        self.assertEqual(len(set(writes_by_lines.values())), 1,
+                         f"UPDATE/INSERT statements per cart size: {writes_by_lines}")
@@ -1,11 +1,15 @@
-from django.test import TestCase, Client
+from django.test import TestCase, TransactionTestCase, Client
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.messages import get_messages
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from core.models import Item, Order, OrderItem, Coupon, Address, Refund, UserProfile, Payment
 from core.views import is_valid_form, create_ref_code
 from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
 from django.urls import reverse
+from unittest import skipIf
 from unittest.mock import patch, Mock
 from stripe import error as stripe_error
 
@@ -208,6 +212,84 @@ class CartViewsTest(TestCase):
         self.assertRedirects(response, reverse("core:product", args=['test-item']))
 
 
+@skipIf(connection.vendor == 'sqlite',
+        "SQLite locks the whole test database on concurrent writes; run against PostgreSQL")
+class CartConcurrencyTest(TransactionTestCase):
+    """Fires parallel cart requests from threads, like fast +/- clicks in the cart.
+
+    Needs a database with row-level locking (PostgreSQL) and Django 3.0 or later.
+    On SQLite the threads fail with "database table is locked" whether or not the
+    views are fixed. See "Running the cart concurrency tests" in the test plan.
+    """
+    clicks = 200
+    workers = 16
+
+    def setUp(self):
+        self.user = User.objects.create(username="testuser")
+        self.item = Item.objects.create(title="Test Item",
+                                        price=float(2),
+                                        discount_price=float(1),
+                                        category="S",
+                                        label="S",
+                                        slug="test-item",
+                                        description="Test item",
+                                        image=None)
+
+    def post_concurrently(self, path):
+        clients = []
+        for _ in range(self.clicks):
+            # A view error such as MultipleObjectsReturned comes back as a 500 in the results.
+            client = Client(raise_request_exception=False)
+            client.force_login(self.user)
+            clients.append(client)
+
+        def post(client):
+            try:
+                return client.post(path).status_code
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(post, clients))
+
+    def test_add_to_cart_concurrent_increments(self):
+        order_item = OrderItem.objects.create(user=self.user, ordered=False, item=self.item, quantity=1)
+        order = Order.objects.create(user=self.user,
+                                     ordered_date=datetime.now(timezone.utc),
+                                     ordered=False)
+        order.items.set([order_item])
+
+        results = self.post_concurrently('/add-to-cart/test-item/')
+
+        self.assertEqual(results, [302] * self.clicks)
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(OrderItem.objects.count(), 1)
+        order_item.refresh_from_db()
+        self.assertEqual(order_item.quantity, self.clicks + 1)
+
+    def test_add_to_cart_concurrent_first_add_creates_single_order(self):
+        results = self.post_concurrently('/add-to-cart/test-item/')
+
+        self.assertEqual(results, [302] * self.clicks)
+        self.assertEqual(Order.objects.filter(user=self.user, ordered=False).count(), 1)
+        self.assertEqual(OrderItem.objects.filter(user=self.user, ordered=False).count(), 1)
+        self.assertEqual(OrderItem.objects.get(user=self.user).quantity, self.clicks)
+
+    def test_remove_single_item_from_cart_concurrent_decrements(self):
+        order_item = OrderItem.objects.create(user=self.user, ordered=False, item=self.item,
+                                              quantity=self.clicks + 1)
+        order = Order.objects.create(user=self.user,
+                                     ordered_date=datetime.now(timezone.utc),
+                                     ordered=False)
+        order.items.set([order_item])
+
+        results = self.post_concurrently('/remove-item-from-cart/test-item/')
+
+        self.assertEqual(results, [302] * self.clicks)
+        order_item.refresh_from_db()
+        self.assertEqual(order_item.quantity, 1)
+
+
 class CouponViewTest(TestCase):
     @classmethod
     def setUpTestData(cls):
@@ -568,6 +650,61 @@ class CheckoutViewTest(TestCase):
         self.assertIn("didn't return an HttpResponse", str(context.exception))
 
 
+class CheckoutViewQueryCountTest(CheckoutViewTest):
+    """Runs every CheckoutViewTest path again and counts the queries of each checkout request.
+
+    The totals pin the current cost of every MC/DC path, so any extra query shows up
+    as a failure. Each request may read the address book at most once; paths that
+    repeat the default address lookups (exists() followed by [0]) are expected to
+    fail that check until CheckoutView loads the addresses once per request.
+    """
+    # Measured with the SQLite test database. The GET paths include the navbar
+    # cart_item_count (3 queries) and order_snippet (4 queries for the 1-line cart).
+    expected_queries = {
+        'test_get_checkout_view': 12,
+        'test_get_checkout_view_shipping_address_default': 13,
+        'test_get_checkout_view_shipping_address_not_default': 12,
+        'test_get_checkout_view_billing_address_default': 13,
+        'test_get_checkout_view_billing_address_not_default': 12,
+        'test_get_checkout_view_no_active_order': 3,
+        'test_get_checkout_view_both_addresses_default': 14,
+        'test_post_checkout_view_no_active_order': 3,
+        'test_post_checkout_view_invalid_form': 3,
+        'test_mcdc_default_shipping_same_billing_stripe': 9,
+        'test_mcdc_default_shipping_not_exists_same_billing': 4,
+        'test_mcdc_new_shipping_set_default_same_billing_paypal': 9,
+        'test_mcdc_invalid_shipping_same_billing': 3,
+        'test_mcdc_default_shipping_default_billing_exists': 9,
+        'test_mcdc_default_shipping_default_billing_not_exists': 7,
+        'test_mcdc_valid_new_shipping_default_billing_exists': 8,
+        'test_mcdc_new_shipping_default_billing_not_exists': 6,
+        'test_mcdc_invalid_shipping_default_billing': 6,
+        'test_mcdc_default_shipping_new_billing_set_default': 9,
+        'test_mcdc_default_shipping_invalid_billing': 6,
+        'test_mcdc_new_shipping_new_billing_set_default': 7,
+        'test_mcdc_invalid_payment_option': 3,
+    }
+
+    def setUp(self):
+        super().setUp()
+        self.client.get = self.with_query_count(self.client.get)
+        self.client.post = self.with_query_count(self.client.post)
+
+    def with_query_count(self, request):
+        def counted_request(path, *args, **kwargs):
+            if path != self.url:
+                return request(path, *args, **kwargs)
+            with self.assertNumQueries(self.expected_queries[self._testMethodName]) as queries:
+                response = request(path, *args, **kwargs)
+            address_queries = [query['sql'] for query in queries.captured_queries
+                               if query['sql'].startswith('SELECT') and 'FROM "core_address"' in query['sql']]
+            self.assertLessEqual(len(address_queries), 1,
+                                 f"{len(address_queries)} address queries for {path}: " +
+                                 "; ".join(address_queries))
+            return response
+        return counted_request
+
+
 class StripeCreateCalled(Exception):
     pass
 